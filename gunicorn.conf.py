@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+
+# preload_app imports the app in the master, before the gevent worker would
+# patch the stdlib, and requests/urllib3 must see green ssl and sockets and
+# the DB pool semaphore must be a gevent one. gunicorn itself has already
+# imported ssl, logging and threading by the time it reads this file, so
+# the Procfile starts it via `python -m gevent.monkey --module gunicorn`,
+# which patches before anything is imported. Launched as plain `gunicorn`,
+# fall back to patching here; gevent then warns about ssl being imported
+# first, and that case is accepted, not supported.
+from gevent import monkey
+
+if not monkey.is_module_patched("socket"):
+    monkey.patch_all()
+
+# ------------------------------------------------------------------
+# Workers
+# ------------------------------------------------------------------
+# The app is almost entirely I/O wait (Intuit token exchange, userinfo,
+# one Postgres upsert), so cooperative gevent workers serve many in-flight
+# OAuth callbacks each instead of one per sync worker.
+worker_class = "gevent"
+workers = int(os.getenv("GUNICORN_WORKERS", str(multiprocessing.cpu_count())))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+# Postgres connections are budgeted per instance, not per worker: each
+# worker's pool gets PG_MAX_CONNECTIONS // workers, e.g. 40 // 8 = 5 on an
+# 8-CPU host, so the instance holds at most 40. PG_POOL_MIN is set to the
+# same value, because psycopg2's pool closes returned connections above
+# minconn idle and would reconnect under every burst. Each worker keeps at
+# least 2, so above PG_MAX_CONNECTIONS / 2 workers the budget is exceeded;
+# lower GUNICORN_WORKERS there. Keep instances * PG_MAX_CONNECTIONS under
+# the server's max_connections (100 by default). Greenlets beyond the pool
+# queue on its semaphore for PG_POOL_TIMEOUT.
+pg_max_connections = int(os.getenv("PG_MAX_CONNECTIONS", "40"))
+pg_pool_size = str(max(2, pg_max_connections // workers))
+os.environ.setdefault("PG_POOL_MAX", pg_pool_size)
+os.environ.setdefault("PG_POOL_MIN", os.environ["PG_POOL_MAX"])
+
+# Import the app once in the master; the HTTP session, executor and
+# prepared SQL are then shared copy-on-write. The DB pool is created
+# lazily, after fork, in each worker.
+preload_app = True
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+keepalive = 30
+
+# ------------------------------------------------------------------
+# Hooks
+# ------------------------------------------------------------------
+def post_fork(server, worker):
+    # The stdlib is monkey-patched before the app loads; psycopg2 talks to
+    # libpq directly and needs psycogreen so queries yield to the hub.
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
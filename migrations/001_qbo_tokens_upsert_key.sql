@@ -0,0 +1,10 @@
+-- Unique key backing upsert_qbo_token()'s
+--   ON CONFLICT (tenant_id, realm_id, qbo_environment)
+-- so the conflict probe is an index lookup.
+--
+-- CONCURRENTLY cannot run inside a transaction block: apply with
+-- autocommit (e.g. `psql -f`), not from a migration wrapper that adds BEGIN.
+-- IF NOT EXISTS only matches on the index name; if the table already has an
+-- equivalent unique constraint under another name, skip this file.
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS qbo_tokens_upsert_key
+    ON config.qbo_oauth_tokens (tenant_id, realm_id, qbo_environment);
@@ -0,0 +1,16 @@
+-- Encrypted token storage for upsert_qbo_token() when QBO_TOKEN_KEY is set.
+-- Apply this before deploying with QBO_TOKEN_KEY; without the key the app
+-- never touches the *_enc columns and does not need this migration.
+--
+-- Each *_enc value is a 12-byte AES-GCM nonce followed by the ciphertext
+-- and tag, authenticated against the row's tenant_id, realm_id and
+-- qbo_environment plus the column name; decrypt with open_qbo_token().
+-- While QBO_TOKEN_KEY is set the app writes NULL to the plaintext columns,
+-- so they must be nullable.
+-- Drop access_token/refresh_token once every reader has moved to the
+-- *_enc columns and all rows have been re-written.
+ALTER TABLE config.qbo_oauth_tokens
+    ADD COLUMN IF NOT EXISTS access_token_enc bytea,
+    ADD COLUMN IF NOT EXISTS refresh_token_enc bytea,
+    ALTER COLUMN access_token DROP NOT NULL,
+    ALTER COLUMN refresh_token DROP NOT NULL;
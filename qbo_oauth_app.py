@@ -1,13 +1,28 @@
+import base64
+import functools
 import os
-from datetime import datetime, timezone, timedelta
+import select
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from urllib.parse import quote
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from dotenv import load_dotenv
-from flask import Flask, request, render_template_string
+from flask import Flask, redirect, request, url_for
 from authlib.integrations.flask_client import OAuth
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 import psycopg2
+from psycopg2 import pool
+from psycopg2.extras import execute_values
 
 # ------------------------------------------------------------------
 # App setup
@@ -15,7 +30,11 @@ import psycopg2
 load_dotenv()
 
 APP = Flask(__name__)
+APP.logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 APP.secret_key = os.getenv("FLASK_SECRET_KEY")
+if not APP.secret_key:
+    # Every worker must sign the OAuth state cookie with the same key.
+    raise RuntimeError("FLASK_SECRET_KEY not set")
 
 APP.wsgi_app = ProxyFix(APP.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
@@ -23,15 +42,23 @@ APP.config.update(
     SESSION_COOKIE_SECURE=True,
     SESSION_COOKIE_HTTPONLY=True,
     SESSION_COOKIE_SAMESITE="Lax",
+    SESSION_COOKIE_DOMAIN=os.getenv("SESSION_COOKIE_DOMAIN") or None,
     PERMANENT_SESSION_LIFETIME=timedelta(days=90),
 )
 
 PG_DB_URL = os.getenv("PG_DB_URL")
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+# psycopg2's pool closes a returned connection once PG_POOL_MIN are idle,
+# so anything below PG_POOL_MAX reconnects (and re-PREPAREs) under load.
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", str(PG_POOL_MAX)))
+PG_POOL_TIMEOUT = float(os.getenv("PG_POOL_TIMEOUT", "10"))
 
 CLIENT_ID = os.getenv("INTUIT_CLIENT_ID")
 CLIENT_SECRET = os.getenv("INTUIT_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("INTUIT_REDIRECT_URI")
 QBO_ENV = (os.getenv("QBO_ENV", "sandbox") or "sandbox").lower()
+# urlsafe base64 of a 16/24/32-byte AES key; unset keeps plaintext tokens
+QBO_TOKEN_KEY = os.getenv("QBO_TOKEN_KEY")
 
 AUTH_URL = "https://appcenter.intuit.com/connect/oauth2"
 TOKEN_URL = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
@@ -44,6 +71,55 @@ RETURN_URL = (
     "dashboard/sourceintegration?source=quickbooks"
 )
 
+# Token exchange request parts that only depend on configuration
+TOKEN_HEADERS = {
+    "Authorization": "Basic "
+    + base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode(),
+    "Accept": "application/json",
+    "Content-Type": "application/x-www-form-urlencoded",
+}
+TOKEN_BODY_FMT = (
+    "grant_type=authorization_code"
+    f"&redirect_uri={quote(REDIRECT_URI or '', safe='')}"
+    "&code={}"
+)
+
+# (connect, read) seconds for calls to Intuit
+HTTP_TIMEOUT = (3, 7)
+
+# ------------------------------------------------------------------
+# HTTP session (keep-alive + TLS reuse for Intuit endpoints)
+# ------------------------------------------------------------------
+def _intuit_adapter(status_forcelist, allowed_methods):
+    # Retry-After is ignored so a 503 cannot park the worker for an
+    # arbitrary time. Each of up to 3 attempts can take 3 s to connect and
+    # 7 s to read, so the worst case per call is about 31 s including the
+    # 0.6 s backoff.
+    return HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=50,
+        max_retries=Retry(
+            total=2,
+            connect=2,
+            read=0,
+            backoff_factor=0.3,
+            status_forcelist=status_forcelist,
+            allowed_methods=allowed_methods,
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        ),
+    )
+
+HTTP = requests.Session()
+# Userinfo is an idempotent GET: retry connect failures and gateway 5xx.
+HTTP.mount("https://", _intuit_adapter((502, 503, 504), frozenset(["GET"])))
+# Authorization codes are single-use, so the token POST is only retried when
+# Intuit cannot have redeemed one: connect failures, and 503 where the
+# service refused the request. 502 and 504 mean an upstream was reached and
+# may have redeemed the code, as may a lost response (read=0); re-sending
+# there would turn the real error into invalid_grant.
+HTTP.mount(TOKEN_URL, _intuit_adapter((503,), frozenset(["POST"])))
+
 # ------------------------------------------------------------------
 # OAuth client
 # ------------------------------------------------------------------
@@ -60,11 +136,266 @@ intuit = oauth.register(
 # ------------------------------------------------------------------
 # Database helpers
 # ------------------------------------------------------------------
+# One pool per process, created on first use so that workers forked by
+# gunicorn never share sockets opened in the master.
+_POOL = None
+_POOL_LOCK = threading.Lock()
+# ThreadedConnectionPool raises instead of waiting when it is exhausted;
+# the semaphore makes callers queue for a free slot, up to PG_POOL_TIMEOUT.
+_POOL_SLOTS = threading.BoundedSemaphore(PG_POOL_MAX)
+
+def get_db_pool():
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                if not PG_DB_URL:
+                    raise RuntimeError("PG_DB_URL not set")
+                _POOL = pool.ThreadedConnectionPool(PG_POOL_MIN, PG_POOL_MAX, PG_DB_URL)
+    return _POOL
+
+def _is_stale(conn):
+    # An idle pooled connection has nothing to read unless the server has
+    # sent something, typically a FATAL notice followed by EOF; draining it
+    # with poll() raises once the socket is gone. Costs a zero-timeout
+    # select(), not a round trip.
+    try:
+        while not conn.closed and select.select([conn], [], [], 0)[0]:
+            conn.poll()
+    except psycopg2.Error:
+        return True
+    return bool(conn.closed)
+
+@contextmanager
 def get_db_conn():
-    if not PG_DB_URL:
-        raise RuntimeError("PG_DB_URL not set")
-    return psycopg2.connect(PG_DB_URL)
+    """Borrow a pooled connection; commit on success, roll back on error."""
+    db_pool = get_db_pool()
+    if not _POOL_SLOTS.acquire(timeout=PG_POOL_TIMEOUT):
+        raise pool.PoolError("timed out waiting for a database connection")
+    try:
+        conn = db_pool.getconn()
+        while _is_stale(conn):
+            db_pool.putconn(conn, close=True)
+            conn = db_pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            db_pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        _POOL_SLOTS.release()
+
+def retry_on_disconnect(fn):
+    """Run fn again, once, if its connection dropped mid-request.
+
+    Server-side errors carry a SQLSTATE (pgcode); a lost connection
+    (restart, failover, network reset) does not. get_db_conn() has already
+    discarded the dead connection, so the retry gets a fresh one. Only wrap
+    idempotent writes.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if e.pgcode is not None:
+                raise
+            APP.logger.warning("Postgres connection lost in %s; retrying", fn.__name__)
+            return fn(*args, **kwargs)
+    return wrapper
+
+# ------------------------------------------------------------------
+# Token encryption
+# ------------------------------------------------------------------
+# With QBO_TOKEN_KEY set, tokens are stored only as AES-GCM ciphertext in
+# the *_token_enc bytea columns (nonce || ciphertext || tag) and the
+# plaintext columns are written NULL. The AAD binds each value to its
+# row key (tenant, realm, environment) and column, so ciphertexts cannot
+# be swapped between rows. The parts are NUL-joined, which is unambiguous
+# because Postgres text values cannot contain NUL.
+_TOKEN_AEAD = AESGCM(base64.urlsafe_b64decode(QBO_TOKEN_KEY)) if QBO_TOKEN_KEY else None
+_TOKEN_NONCE_BYTES = 12
+
+def _token_aad(tenant_id: str, realm_id: str, qbo_environment: str, column: str) -> bytes:
+    return "\0".join((tenant_id, realm_id, qbo_environment, column)).encode()
+
+def seal_qbo_token(value: str, tenant_id: str, realm_id: str, qbo_environment: str, column: str):
+    if value is None:
+        return None
+    nonce = os.urandom(_TOKEN_NONCE_BYTES)
+    aad = _token_aad(tenant_id, realm_id, qbo_environment, column)
+    return nonce + _TOKEN_AEAD.encrypt(nonce, value.encode(), aad)
+
+def open_qbo_token(blob, tenant_id: str, realm_id: str, qbo_environment: str, column: str):
+    """Decrypt a *_token_enc value read from config.qbo_oauth_tokens."""
+    if blob is None:
+        return None
+    if not _TOKEN_AEAD:
+        raise RuntimeError("QBO_TOKEN_KEY not set")
+    blob = bytes(blob)
+    aad = _token_aad(tenant_id, realm_id, qbo_environment, column)
+    nonce, ciphertext = blob[:_TOKEN_NONCE_BYTES], blob[_TOKEN_NONCE_BYTES:]
+    return _TOKEN_AEAD.decrypt(nonce, ciphertext, aad).decode()
+
+# The *_enc columns come from migrations/002 and are only written while
+# QBO_TOKEN_KEY is set, so a plaintext deploy does not need that migration.
+_TOKEN_ENC_COLUMNS = ("access_token_enc", "refresh_token_enc") if _TOKEN_AEAD else ()
+
+# Parameters of the token upsert, in the order the prepared statement
+# numbers them ($1, $2, ...).
+_UPSERT_PARAMS = (
+    "tenant_id",
+    "realm_id",
+    "intuit_user_id",
+    "intuit_email",
+    "access_token",
+    "refresh_token",
+    *_TOKEN_ENC_COLUMNS,
+    "token_type",
+    "expires_in",
+    "refresh_expires_in",
+    "qbo_environment",
+    "client_id",
+)
 
+_UPSERT_INSERT = f"""
+    INSERT INTO config.qbo_oauth_tokens (
+        tenant_id,
+        realm_id,
+        intuit_user_id,
+        intuit_email,
+        access_token,
+        refresh_token,
+        {"".join(f"{c}, " for c in _TOKEN_ENC_COLUMNS)}
+        token_type,
+        expires_in,
+        refresh_expires_in,
+        issued_at_utc,
+        access_token_expires_at,
+        refresh_token_expires_at,
+        qbo_environment,
+        client_id,
+        created_at,
+        updated_at
+    )
+"""
+
+# One row of VALUES with named placeholders; used as the execute_values()
+# template for bulk writes and rendered with $n markers for PREPARE.
+_UPSERT_ROW = f"""(
+    %(tenant_id)s,%(realm_id)s,%(intuit_user_id)s,%(intuit_email)s,
+    %(access_token)s,%(refresh_token)s,
+    {"".join(f"%({c})s," for c in _TOKEN_ENC_COLUMNS)}%(token_type)s,
+    %(expires_in)s,%(refresh_expires_in)s,
+    now(),
+    now() + make_interval(secs => %(expires_in)s::integer),
+    now() + make_interval(secs => %(refresh_expires_in)s::integer),
+    %(qbo_environment)s,%(client_id)s,now(),now()
+)"""
+
+_UPSERT_CONFLICT = f"""
+    ON CONFLICT (tenant_id, realm_id, qbo_environment)
+    DO UPDATE SET
+        access_token = EXCLUDED.access_token,
+        refresh_token = EXCLUDED.refresh_token,
+        {"".join(f"{c} = EXCLUDED.{c}, " for c in _TOKEN_ENC_COLUMNS)}
+        expires_in = EXCLUDED.expires_in,
+        refresh_expires_in = EXCLUDED.refresh_expires_in,
+        issued_at_utc = EXCLUDED.issued_at_utc,
+        access_token_expires_at = EXCLUDED.access_token_expires_at,
+        refresh_token_expires_at = EXCLUDED.refresh_token_expires_at,
+        intuit_user_id = EXCLUDED.intuit_user_id,
+        intuit_email = EXCLUDED.intuit_email,
+        updated_at = now()
+"""
+
+# Every write announces the realm on QBO_TOKEN_CHANNEL inside the same
+# statement, so listeners learn about token changes with no extra round trip.
+# Notifications are delivered on commit and deduplicated per transaction.
+QBO_TOKEN_CHANNEL = "qbo_token_updated"
+
+# xmax is 0 only on a freshly inserted tuple, so each returned row also
+# says whether the upsert created the connection or refreshed it.
+_UPSERT_NOTIFY = f"""
+    RETURNING realm_id, (xmax = 0) AS inserted
+)
+SELECT inserted, pg_notify('{QBO_TOKEN_CHANNEL}', realm_id) FROM upserted
+"""
+
+# Prepared once per pooled connection; later upserts send only EXECUTE
+# plus parameters, so Postgres skips parse/plan on every callback.
+_UPSERT_STATEMENT = "qbo_upsert"
+
+_UPSERT_SQL = (
+    "WITH upserted AS ("
+    + _UPSERT_INSERT
+    + "VALUES "
+    + _UPSERT_ROW % {name: f"${i}" for i, name in enumerate(_UPSERT_PARAMS, 1)}
+    + _UPSERT_CONFLICT
+    + _UPSERT_NOTIFY
+)
+
+# The interactive upsert skips waiting for the WAL flush on commit. A crash
+# inside that window (well under a second) can lose the newest row, which
+# the user recovers by reconnecting QuickBooks; the bulk refresh path keeps
+# full durability because it stores rotated refresh tokens that may not
+# be re-obtainable. Sent in the same round trip as the EXECUTE.
+_UPSERT_EXECUTE = (
+    "SET LOCAL synchronous_commit = off; "
+    f"EXECUTE {_UPSERT_STATEMENT} ({','.join(f'%({n})s' for n in _UPSERT_PARAMS)})"
+)
+
+# execute_values() expands the single %s into pages of _UPSERT_ROW.
+_UPSERT_BULK_SQL = (
+    "WITH upserted AS (" + _UPSERT_INSERT + "VALUES %s" + _UPSERT_CONFLICT + _UPSERT_NOTIFY
+)
+
+# Connections that already hold the prepared upsert. Entries disappear when
+# the pool drops a connection, so a replacement gets prepared again.
+_PREPARED_CONNS = weakref.WeakSet()
+
+def _prepare_upsert(cur):
+    conn = cur.connection
+    if conn not in _PREPARED_CONNS:
+        cur.execute(f"PREPARE {_UPSERT_STATEMENT} AS {_UPSERT_SQL}")
+        _PREPARED_CONNS.add(conn)
+
+def _upsert_params(
+    token: dict,
+    realm_id: str,
+    tenant_id: str,
+    intuit_email: str = None,
+    intuit_user_id: str = None,
+) -> dict:
+    access_token = token.get("access_token")
+    refresh_token = token.get("refresh_token")
+
+    params = {
+        "tenant_id": tenant_id,
+        "realm_id": realm_id,
+        "intuit_user_id": intuit_user_id,
+        "intuit_email": intuit_email,
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "token_type": token.get("token_type", "bearer"),
+        "expires_in": token.get("expires_in"),
+        "refresh_expires_in": token.get("x_refresh_token_expires_in"),
+        "qbo_environment": QBO_ENV,
+        "client_id": CLIENT_ID,
+    }
+    if _TOKEN_AEAD:
+        for column in ("access_token", "refresh_token"):
+            params[f"{column}_enc"] = seal_qbo_token(
+                params[column], tenant_id, realm_id, QBO_ENV, column
+            )
+            params[column] = None
+    return params
+
+@retry_on_disconnect
 def upsert_qbo_token(
     token: dict,
     realm_id: str,
@@ -72,79 +403,152 @@ def upsert_qbo_token(
     intuit_email: str = None,
     intuit_user_id: str = None,
 ):
-    conn = None
-    cur = None
-    try:
-        conn = get_db_conn()
-        cur = conn.cursor()
+    params = _upsert_params(token, realm_id, tenant_id, intuit_email, intuit_user_id)
+
+    with get_db_conn() as conn, conn.cursor() as cur:
+        _prepare_upsert(cur)
+        cur.execute(_UPSERT_EXECUTE, params)
+        inserted = cur.fetchone()[0]
+
+    APP.logger.info(
+        "QBO token upsert realm_id=%s tenant_id=%s inserted=%s",
+        realm_id,
+        tenant_id,
+        inserted,
+    )
+    return inserted
+
+def upsert_qbo_tokens_bulk(rows, page_size: int = 200):
+    """Upsert many tokens in one statement per page.
+
+    Each row is a dict of upsert_qbo_token() keyword arguments. As there,
+    intuit_email/intuit_user_id are written as given, so pass the row's
+    current identity to keep it. rows may be
+    any iterable, including a generator, and is consumed once. Later rows
+    win when the same (tenant_id, realm_id) appears twice, since a single
+    INSERT ... ON CONFLICT cannot update one row twice. Returns how many
+    rows were newly inserted.
+    """
+    params = {}
+    for row in rows:
+        p = _upsert_params(**row)
+        params[(p["tenant_id"], p["realm_id"])] = p
+
+    if not params:
+        return 0
+
+    # Only the DB write is retried, with the already-built list, so a retry
+    # after a disconnect re-sends every row instead of an exhausted iterator.
+    results = _write_qbo_tokens_bulk(list(params.values()), page_size)
+
+    inserted = sum(1 for r in results if r[0])
+    APP.logger.info(
+        "QBO bulk token upsert rows=%d inserted=%d updated=%d",
+        len(results),
+        inserted,
+        len(results) - inserted,
+    )
+    return inserted
+
+@retry_on_disconnect
+def _write_qbo_tokens_bulk(params: list, page_size: int):
+    with get_db_conn() as conn, conn.cursor() as cur:
+        return execute_values(
+            cur,
+            _UPSERT_BULK_SQL,
+            params,
+            template=_UPSERT_ROW,
+            page_size=page_size,
+            fetch=True,
+        )
+
+@retry_on_disconnect
+def update_qbo_userinfo(
+    realm_id: str,
+    tenant_id: str,
+    intuit_email: str = None,
+    intuit_user_id: str = None,
+):
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE config.qbo_oauth_tokens
+            SET intuit_email = %s,
+                intuit_user_id = %s,
+                updated_at = now()
+            WHERE tenant_id = %s
+              AND realm_id = %s
+              AND qbo_environment = %s
+            """,
+            (intuit_email, intuit_user_id, tenant_id, realm_id, QBO_ENV),
+        )
 
-        issued_at = datetime.now(timezone.utc)
+def listen_qbo_token_updates(timeout: float = 60.0):
+    """Yield the realm_id of every token upsert, as it commits.
 
-        expires_in = token.get("expires_in")
-        refresh_expires_in = token.get("x_refresh_token_expires_in")
+    Yields None after each `timeout` seconds without a notification, so the
+    caller regains control for periodic work or a shutdown check; skip
+    None values otherwise. Uses its own connection rather than a pooled
+    one: LISTEN is session state and the connection sits idle in select()
+    between notifications.
+    """
+    if not PG_DB_URL:
+        raise RuntimeError("PG_DB_URL not set")
 
-        access_expiry = issued_at.timestamp() + expires_in if expires_in else None
-        refresh_expiry = issued_at.timestamp() + refresh_expires_in if refresh_expires_in else None
+    conn = psycopg2.connect(PG_DB_URL)
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {QBO_TOKEN_CHANNEL}")
+
+        while True:
+            if not select.select([conn], [], [], timeout)[0]:
+                yield None
+                continue
+            conn.poll()
+            while conn.notifies:
+                yield conn.notifies.pop(0).payload
+    finally:
+        conn.close()
 
-        cur.execute(
-            """
-            INSERT INTO config.qbo_oauth_tokens (
-                tenant_id,
+# ------------------------------------------------------------------
+# Background work
+# ------------------------------------------------------------------
+EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="qbo-bg")
+
+def fetch_and_store_userinfo(access_token: str, realm_id: str, tenant_id: str):
+    t0 = time.monotonic()
+    try:
+        r = HTTP.get(
+            USERINFO_URL,
+            headers={"Authorization": f"Bearer {access_token}"},
+            timeout=HTTP_TIMEOUT,
+        )
+        t1 = time.monotonic()
+        if r.status_code != 200:
+            APP.logger.warning(
+                "Intuit userinfo returned %s realm_id=%s userinfo_ms=%.1f",
+                r.status_code,
                 realm_id,
-                intuit_user_id,
-                intuit_email,
-                access_token,
-                refresh_token,
-                token_type,
-                expires_in,
-                refresh_expires_in,
-                issued_at_utc,
-                access_token_expires_at,
-                refresh_token_expires_at,
-                qbo_environment,
-                client_id,
-                created_at,
-                updated_at
+                (t1 - t0) * 1000,
             )
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,
-                    to_timestamp(%s),to_timestamp(%s),
-                    %s,%s,now(),now())
-            ON CONFLICT (tenant_id, realm_id, qbo_environment)
-            DO UPDATE SET
-                access_token = EXCLUDED.access_token,
-                refresh_token = EXCLUDED.refresh_token,
-                expires_in = EXCLUDED.expires_in,
-                refresh_expires_in = EXCLUDED.refresh_expires_in,
-                issued_at_utc = EXCLUDED.issued_at_utc,
-                access_token_expires_at = EXCLUDED.access_token_expires_at,
-                refresh_token_expires_at = EXCLUDED.refresh_token_expires_at,
-                intuit_user_id = EXCLUDED.intuit_user_id,
-                intuit_email = EXCLUDED.intuit_email,
-                updated_at = now();
-            """,
-            (
-                tenant_id,
-                realm_id,
-                intuit_user_id,
-                intuit_email,
-                token.get("access_token"),
-                token.get("refresh_token"),
-                token.get("token_type", "bearer"),
-                expires_in,
-                refresh_expires_in,
-                issued_at,
-                access_expiry,
-                refresh_expiry,
-                QBO_ENV,
-                CLIENT_ID,
-            ),
+            return
+
+        data = orjson.loads(r.content)
+        update_qbo_userinfo(
+            realm_id=realm_id,
+            tenant_id=tenant_id,
+            intuit_email=data.get("email"),
+            intuit_user_id=data.get("sub"),
         )
-        conn.commit()
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+        APP.logger.info(
+            "Intuit userinfo realm_id=%s userinfo_ms=%.1f db_update_ms=%.1f",
+            realm_id,
+            (t1 - t0) * 1000,
+            (time.monotonic() - t1) * 1000,
+        )
+    except Exception:
+        APP.logger.exception("Intuit userinfo update failure")
 
 # ------------------------------------------------------------------
 # OAuth flow
@@ -155,22 +559,7 @@ def start():
     if not tenant_id:
         return "Missing tenant_id", 400
 
-    return render_template_string(
-        """
-        <!doctype html>
-        <html>
-          <body style="font-family: system-ui; text-align:center; margin-top:20%">
-            <p>Please wait… Connecting to QuickBooks</p>
-            <script>
-              setTimeout(function() {
-                window.location.href = "/oauth?tenant_id={{ tenant_id }}";
-              }, 1200);
-            </script>
-          </body>
-        </html>
-        """,
-        tenant_id=tenant_id,
-    )
+    return redirect(url_for("oauth_start", tenant_id=tenant_id))
 
 @APP.route("/oauth")
 def oauth_start():
@@ -194,61 +583,53 @@ def callback():
     if not code or not realm_id or not tenant_id:
         return "Invalid OAuth response", 400
 
+    # Keep the phases in this order: the pooled DB connection is only
+    # borrowed in the upsert, never held across a call to Intuit.
+    t0 = time.monotonic()
     try:
-        response = requests.post(
+        # 1) token exchange
+        response = HTTP.post(
             TOKEN_URL,
-            auth=(CLIENT_ID, CLIENT_SECRET),
-            data={
-                "grant_type": "authorization_code",
-                "code": code,
-                "redirect_uri": REDIRECT_URI,
-            },
-            timeout=10,
+            headers=TOKEN_HEADERS,
+            data=TOKEN_BODY_FMT.format(quote(code, safe="")),
+            timeout=HTTP_TIMEOUT,
         )
-        token = response.json()
-
-        intuit_email = None
-        intuit_user_id = None
-
-        if token.get("access_token"):
-            r = requests.get(
-                USERINFO_URL,
-                headers={"Authorization": f"Bearer {token['access_token']}"},
-                timeout=10,
-            )
-            if r.status_code == 200:
-                data = r.json()
-                intuit_email = data.get("email")
-                intuit_user_id = data.get("sub")
+        response.raise_for_status()
+        token = orjson.loads(response.content)
+        t1 = time.monotonic()
 
+        # 2) db upsert
         upsert_qbo_token(
             token=token,
             realm_id=realm_id,
             tenant_id=tenant_id,
-            intuit_email=intuit_email,
-            intuit_user_id=intuit_user_id,
+        )
+        t2 = time.monotonic()
+
+        # 3) userinfo: Intuit identity is not needed to finish the connect;
+        # fill it in after the response has gone out. Until then (or if it
+        # fails) the row's identity is NULL, never a previous user's.
+        if token.get("access_token"):
+            EXECUTOR.submit(
+                fetch_and_store_userinfo,
+                token["access_token"],
+                realm_id,
+                tenant_id,
+            )
+
+        APP.logger.info(
+            "OAuth callback realm_id=%s token_exchange_ms=%.1f db_upsert_ms=%.1f total_ms=%.1f",
+            realm_id,
+            (t1 - t0) * 1000,
+            (t2 - t1) * 1000,
+            (time.monotonic() - t0) * 1000,
         )
 
-    except Exception as e:
+    except Exception:
         APP.logger.exception("OAuth callback failure")
         return "Authentication failed", 500
 
-    return render_template_string(
-        """
-        <!doctype html>
-        <html>
-          <body style="font-family: system-ui; text-align:center; margin-top:20%">
-            <p>QuickBooks connected successfully</p>
-            <script>
-              setTimeout(function() {
-                window.location.href = "{{ url }}";
-              }, 1200);
-            </script>
-          </body>
-        </html>
-        """,
-        url=RETURN_URL,
-    )
+    return redirect(RETURN_URL)
 
 if __name__ == "__main__":
     APP.run(host="127.0.0.1", port=5000)
@@ -0,0 +1,66 @@
+import os
+from contextlib import contextmanager
+from unittest import mock
+
+import psycopg2
+import pytest
+from cryptography.exceptions import InvalidTag
+
+os.environ.setdefault("FLASK_SECRET_KEY", "test")
+
+import qbo_oauth_app  # noqa: E402
+
+
+def test_bulk_upsert_retry_resends_rows_from_generator():
+    attempts = []
+
+    @contextmanager
+    def flaky_db_conn():
+        attempts.append(1)
+        if len(attempts) == 1:
+            # Connection-level failure: no SQLSTATE, so it is retried.
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        yield mock.MagicMock()
+
+    sent = []
+
+    def fake_execute_values(cur, sql, argslist, **kwargs):
+        sent.append(list(argslist))
+        return [(True,) for _ in argslist]
+
+    rows = (
+        dict(token={"access_token": f"a{i}"}, realm_id=f"realm{i}", tenant_id="t1")
+        for i in range(3)
+    )
+
+    with mock.patch.object(qbo_oauth_app, "get_db_conn", flaky_db_conn), \
+            mock.patch.object(qbo_oauth_app, "execute_values", fake_execute_values):
+        inserted = qbo_oauth_app.upsert_qbo_tokens_bulk(rows)
+
+    assert len(attempts) == 2
+    assert inserted == 3
+    assert [p["realm_id"] for p in sent[0]] == ["realm0", "realm1", "realm2"]
+
+
+def test_token_seal_round_trip():
+    aead = qbo_oauth_app.AESGCM(qbo_oauth_app.AESGCM.generate_key(bit_length=256))
+    with mock.patch.object(qbo_oauth_app, "_TOKEN_AEAD", aead):
+        blob = qbo_oauth_app.seal_qbo_token("secret", "t1", "realm1", "sandbox", "access_token")
+        assert b"secret" not in blob
+        assert qbo_oauth_app.open_qbo_token(
+            blob, "t1", "realm1", "sandbox", "access_token"
+        ) == "secret"
+
+
+def test_token_open_rejects_other_row_or_column():
+    aead = qbo_oauth_app.AESGCM(qbo_oauth_app.AESGCM.generate_key(bit_length=256))
+    with mock.patch.object(qbo_oauth_app, "_TOKEN_AEAD", aead):
+        blob = qbo_oauth_app.seal_qbo_token("secret", "t1", "realm1", "sandbox", "access_token")
+        for key in (
+            ("t2", "realm1", "sandbox", "access_token"),
+            ("t1", "realm2", "sandbox", "access_token"),
+            ("t1", "realm1", "production", "access_token"),
+            ("t1", "realm1", "sandbox", "refresh_token"),
+        ):
+            with pytest.raises(InvalidTag):
+                qbo_oauth_app.open_qbo_token(blob, *key)